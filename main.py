@@ -3,10 +3,11 @@
 # /// script
 # requires-python = ">=3.13"
 # dependencies = [
+#     "hf-transfer>=0.1.9",
 #     "httpx>=0.28.1",
-#     "huggingface-hub>=0.33.4",
+#     "huggingface-hub>=0.33.4,<1.0",
 #     "python-decouple>=3.8",
-#     "sh>=2.2.2",
+#     "requests>=2.32.3",
 # ]
 # [tool.uv]
 # exclude-newer = "2025-07-23T00:00:00Z"
@@ -16,7 +17,7 @@
 
 """
 Usage:
-    llm-bench [--download-localscore] [--download-model] <model-path>
+    llm-bench [--download-localscore] [--download-model] [--offline] <model-path>
 
 Args:
     model-path:             Path to the GGUF model file to benchmark
@@ -24,19 +25,22 @@ Args:
 Options:
     --download-localscore:  Download the localscore binary
     --download-model:       Download a model from HuggingFace
+    --offline:              Reuse a previously downloaded model without checking for updates
 
 Note:
     After downloading, copy or symlink this script to a location in your PATH
     (e.g., ~/.local/bin/llm-bench) for easier access.
 """
 
-import httpx
+import functools
+import hashlib
 import os
-import sh
-import stat
-from huggingface_hub import hf_hub_download, hf_hub_url, list_repo_files
+import shutil
+import subprocess
+import sys
+import time
+from importlib.util import find_spec
 from pathlib import Path
-from sh import ErrorReturnCode
 
 env_file = Path.cwd() / ".env"
 if env_file.exists():
@@ -48,23 +52,27 @@ else:
 LOCALSCORE_VERSION = config("LOCALSCORE_VERSION", default="0.9.3")
 LOCALSCORE_URL = f"https://blob.localscore.ai/localscore-{LOCALSCORE_VERSION}"
 LOCALSCORE_BIN = "localscore"
+LOCALSCORE_SHA256 = config("LOCALSCORE_SHA256", default="").lower()
+XDG_CACHE_HOME = config("XDG_CACHE_HOME", default="")
+# Per the XDG spec, an empty or relative XDG_CACHE_HOME is ignored
+CACHE_DIR = (Path(XDG_CACHE_HOME) if Path(XDG_CACHE_HOME).is_absolute() else Path.home() / ".cache") / "llm_bench"
 HF_HUB_DISABLE_TELEMETRY = config("HF_HUB_DISABLE_TELEMETRY", default="1")
 HF_REPO_ID = config("HF_REPO_ID", default="TheBloke/Llama-2-7B-Chat-GGUF")
+HF_DEFAULT_FILENAME = config("HF_DEFAULT_FILENAME", default="")
+HF_HUB_ENABLE_HF_TRANSFER = config("HF_HUB_ENABLE_HF_TRANSFER", default="")
+HF_HUB_OFFLINE = config("HF_HUB_OFFLINE", default=False, cast=bool)
+HF_DOWNLOAD_RETRIES = 5
 MODEL_DIR = Path(config("MODEL_DIR", default=str(Path.cwd() / "models"))).expanduser().resolve()
 
 
+@functools.lru_cache(maxsize=1)
 def find_localscore():
     """Find localscore binary and return its absolute path"""
-    # First check PATH
-    path_str = os.environ.get('PATH', '')
-    path_dirs = path_str.split(os.pathsep)
-    for path_dir in path_dirs:
-        path_dir = Path(path_dir).expanduser().resolve()
-        if path_dir.exists() and path_dir.is_dir():
-            localscore_path = path_dir / LOCALSCORE_BIN
-            # Check if file exists, is a file, and is executable
-            if localscore_path.exists() and localscore_path.is_file() and os.access(localscore_path, os.X_OK):
-                return localscore_path
+    # First check PATH, expanding ~ in entries (shutil.which only returns executable files)
+    path_dirs = os.environ.get('PATH', '').split(os.pathsep)
+    found = shutil.which(LOCALSCORE_BIN, path=os.pathsep.join(os.path.expanduser(d) for d in path_dirs))
+    if found:
+        return Path(found).resolve()
 
     # Then check current directory
     local_path = Path.cwd() / LOCALSCORE_BIN
@@ -75,47 +83,160 @@ def find_localscore():
 
 
 def download_localscore(force=False):
-    """Download localscore binary via httpx"""
+    """Download localscore binary via httpx into a per-version cache and symlink it"""
+    import httpx
+
     # Check if localscore is already available
     if not force and find_localscore():
-        print("localscore is already available. Use --force to download anyway.")
+        print("localscore is already available. Use --force to link the cached version anyway.")
         return
 
-    print(f"Downloading localscore {LOCALSCORE_VERSION}...")
-
-    response = httpx.get(LOCALSCORE_URL, follow_redirects=True)
-    response.raise_for_status()
-
-    # Save with the version-specific name first
-    temp_filename = f"localscore-{LOCALSCORE_VERSION}"
-    with open(temp_filename, "wb") as f:
-        f.write(response.content)
-
-    # Make executable
-    st = os.stat(temp_filename)
-    os.chmod(temp_filename, st.st_mode | stat.S_IEXEC)
-
-    # Rename to just 'localscore'
-    if Path(LOCALSCORE_BIN).exists():
-        os.remove(LOCALSCORE_BIN)
-    os.rename(temp_filename, LOCALSCORE_BIN)
-
-    print(f"Downloaded and made executable: {LOCALSCORE_BIN}")
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    target = CACHE_DIR / f"localscore-{LOCALSCORE_VERSION}"
+
+    # Reuse the cached binary if it matches the expected hash, or else the size the server would send
+    cached = False
+    if target.exists() and LOCALSCORE_SHA256:
+        with open(target, "rb") as f:
+            cached = hashlib.file_digest(f, "sha256").hexdigest() == LOCALSCORE_SHA256
+        if not cached:
+            # Drop the binary that failed verification so it can't be run if the re-download fails too
+            print(f"Cached localscore {LOCALSCORE_VERSION} failed SHA-256 verification, removing it.")
+            link = Path(LOCALSCORE_BIN)
+            if link.is_symlink() and link.resolve() == target.resolve():
+                link.unlink()
+            target.unlink()
+            find_localscore.cache_clear()
+    elif target.exists():
+        try:
+            response = httpx.head(LOCALSCORE_URL, follow_redirects=True)
+            response.raise_for_status()
+            cached = response.headers.get("content-length") == str(target.stat().st_size)
+        except httpx.HTTPError as e:
+            print(f"Could not verify cached localscore ({e}), using it anyway.")
+            cached = True
+
+    if cached:
+        print(f"Using cached localscore {LOCALSCORE_VERSION}: {target}")
+    else:
+        print(f"Downloading localscore {LOCALSCORE_VERSION}...")
+
+        # Stream to a partial file, executable from creation, then move it into place atomically
+        part = target.with_name(f"{target.name}.part")
+        digest = hashlib.sha256()
+        with httpx.stream("GET", LOCALSCORE_URL, follow_redirects=True) as response:
+            response.raise_for_status()
+            fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+            with os.fdopen(fd, "wb") as f:
+                # Stream to disk in 1 MiB chunks instead of buffering the whole binary, hashing as we go
+                for chunk in response.iter_bytes(chunk_size=1024 * 1024):
+                    digest.update(chunk)
+                    f.write(chunk)
+
+        if LOCALSCORE_SHA256 and digest.hexdigest() != LOCALSCORE_SHA256:
+            part.unlink()
+            raise RuntimeError(
+                f"localscore checksum mismatch: expected {LOCALSCORE_SHA256}, got {digest.hexdigest()}"
+            )
+        os.replace(part, target)
+
+    # Point ./localscore at the cached binary, swapping the link atomically
+    tmp_link = Path(f"{LOCALSCORE_BIN}.tmp")
+    tmp_link.unlink(missing_ok=True)
+    tmp_link.symlink_to(target)
+    os.replace(tmp_link, LOCALSCORE_BIN)
+
+    # Invalidate any cached lookup from before the download
+    find_localscore.cache_clear()
+
+    print(f"Linked {LOCALSCORE_BIN} -> {target}")
+
+
+def is_transient(e):
+    """Whether a Hub error is a connection failure, timeout, rate limit or server error worth retrying"""
+    import requests
+    from huggingface_hub.utils import HfHubHTTPError, LocalEntryNotFoundError
+
+    # hf_hub_download wraps failures of its metadata HEAD call in LocalEntryNotFoundError
+    if isinstance(e, LocalEntryNotFoundError):
+        e = e.__cause__
+    if isinstance(e, requests.ConnectionError | requests.Timeout):
+        return True
+    return isinstance(e, HfHubHTTPError) and getattr(e.response, "status_code", None) in (429, 500, 502, 503, 504)
+
+
+def with_retries(func, **kwargs):
+    """Call a huggingface_hub function with exponential backoff on transient errors"""
+    import requests
+    from huggingface_hub.utils import HfHubHTTPError, LocalEntryNotFoundError
+
+    for attempt in range(HF_DOWNLOAD_RETRIES):
+        try:
+            return func(**kwargs)
+        except (HfHubHTTPError, requests.ConnectionError, requests.Timeout) as e:
+            if not is_transient(e) or attempt == HF_DOWNLOAD_RETRIES - 1:
+                raise
+            delay = 2**attempt
+            reason = e.__cause__ if isinstance(e, LocalEntryNotFoundError) else e
+            print(f"Transient error from HuggingFace, retrying in {delay}s: {reason}")
+            time.sleep(delay)
+
+
+def download_hf_file(repo_id, filename, offline=False):
+    """hf_hub_download into MODEL_DIR, trying previously downloaded files first when offline"""
+    from huggingface_hub import hf_hub_download
+    from huggingface_hub.utils import LocalEntryNotFoundError
+
+    if offline:
+        # Return a previously downloaded file without the freshness check round-trip
+        try:
+            return hf_hub_download(repo_id=repo_id, filename=filename, local_dir=MODEL_DIR, local_files_only=True)
+        except LocalEntryNotFoundError:
+            # With HF_HUB_OFFLINE set huggingface_hub blocks the online fallback anyway
+            if HF_HUB_OFFLINE:
+                raise
+            print(f"{filename} not found locally, downloading...")
+
+    return with_retries(hf_hub_download, repo_id=repo_id, filename=filename, local_dir=MODEL_DIR)
+
+
+def download_model_from_hf(repo_id=None, filename=None, offline=False):
+    """Use hf_hub_download to download models"""
+    # Use the Rust hf_transfer backend when available; must be set before huggingface_hub is imported
+    hf_transfer = HF_HUB_ENABLE_HF_TRANSFER or ("1" if find_spec("hf_transfer") else "0")
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", hf_transfer)
+    # huggingface_hub only reads the process environment, so pass on a .env HF_HUB_OFFLINE too
+    if HF_HUB_OFFLINE:
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
 
+    import requests
+    from huggingface_hub import hf_hub_url, list_repo_files
+    from huggingface_hub.utils import EntryNotFoundError, HfHubHTTPError, LocalEntryNotFoundError, OfflineModeIsEnabled
 
-def download_model_from_hf(repo_id=None, filename=None):
-    """Use hf_hub_download to download models"""
     if repo_id is None:
         repo_id = HF_REPO_ID
+    offline = offline or HF_HUB_OFFLINE
 
     MODEL_DIR.mkdir(parents=True, exist_ok=True)
 
     print(f"Downloading model from {repo_id}...")
 
     try:
+        if filename is None and HF_DEFAULT_FILENAME:
+            # Try the configured filename first to skip the list_repo_files round-trip
+            try:
+                model_path = download_hf_file(repo_id, HF_DEFAULT_FILENAME, offline)
+                print(f"Model downloaded to: {model_path}")
+                return Path(model_path)
+            except EntryNotFoundError as e:
+                # LocalEntryNotFoundError means the Hub was unreachable, not that the file is missing
+                if isinstance(e, LocalEntryNotFoundError):
+                    raise
+                print(f"{HF_DEFAULT_FILENAME} not found in {repo_id}, searching for a GGUF file...")
+
         if filename is None:
             # List available files and find a GGUF file
-            files = list_repo_files(repo_id=repo_id)
+            files = with_retries(list_repo_files, repo_id=repo_id)
             gguf_files = [f for f in files if f.endswith('.gguf')]
 
             if not gguf_files:
@@ -130,17 +251,13 @@ def download_model_from_hf(repo_id=None, filename=None):
         url = hf_hub_url(repo_id=repo_id, filename=filename)
         print(f"Downloading from: {url}")
 
-        model_path = hf_hub_download(
-            repo_id=repo_id,
-            filename=filename,
-            local_dir=MODEL_DIR,
-        )
+        model_path = download_hf_file(repo_id, filename, offline)
 
         print(f"Model downloaded to: {model_path}")
         return Path(model_path)
 
-    except Exception as e:
-        print(f"Error downloading model: {e}")
+    except (HfHubHTTPError, OfflineModeIsEnabled, requests.ConnectionError, requests.Timeout) as e:
+        print(f"Error downloading model from {repo_id}: {e}")
         return None
 
 
@@ -152,57 +269,52 @@ def run_localscore(model_path):
         print("Error: localscore not found in PATH or current directory. Run with --download-localscore first.")
         return 1
 
-    # Use the binary name if in PATH, otherwise use absolute path
-    if str(localscore_path.parent) in os.environ.get('PATH', '').split(os.pathsep):
-        cmd_name = "localscore"
-    else:
-        cmd_name = str(localscore_path)
-
-    # Convert model_path to Path object
+    # Candidate locations: the path as given, then relative to MODEL_DIR
     model_path = Path(model_path)
-
-    # Track paths we've tried for better error messages
-    tried_paths = []
-
-    # If the path is relative and doesn't exist, try prepending MODEL_DIR
-    if not model_path.is_absolute() and not model_path.exists():
-        tried_paths.append(model_path.resolve())
-        model_path_with_base = MODEL_DIR / model_path
-        tried_paths.append(model_path_with_base.resolve())
-        if model_path_with_base.exists():
-            model_path = model_path_with_base
-
-    # Resolve to absolute path
-    model_path = model_path.resolve()
-
-    if not model_path.exists():
+    candidates = [model_path]
+    if not model_path.is_absolute():
+        candidates.append(MODEL_DIR / model_path)
+
+    for candidate in candidates:
+        if candidate.exists():
+            model_path = candidate.resolve()
+            break
+    else:
         print("Error: Model file not found.\nLooked for:")
-        for p in tried_paths if tried_paths else [model_path]:
-            print(f"  - {p}")
+        for candidate in candidates:
+            print(f"  - {candidate.absolute()}")
         print(f"\nMODEL_DIR is set to: {MODEL_DIR}")
         return 1
 
-    print(f"Running: {cmd_name} -m {model_path}")
+    print(f"Running: {localscore_path} -m {model_path}")
 
     try:
-        # Build the command string
-        cmd_str = f'{cmd_name} -m {str(model_path)}'
+        # Exec the resolved absolute path directly (no /bin/sh -c, no PATH lookup)
+        argv = [str(localscore_path), "-m", str(model_path)]
+        with subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as p:
+            # Copy raw bytes in chunks; read1 returns whatever is available so progress still shows live
+            sys.stdout.flush()
+            stdout_buf = sys.stdout.buffer
+            for chunk in iter(lambda: p.stdout.read1(65536), b""):
+                stdout_buf.write(chunk)
+                stdout_buf.flush()
+            returncode = p.wait()
+
+        if returncode != 0:
+            print(f"Error running localscore: exited with code {returncode}")
+        return returncode
 
-        # Use sh to invoke /bin/sh with -c flag
-        for line in sh.sh("-c", cmd_str, _iter=True, _err_to_out=True):
-            print(line, end='')
-
-        return 0
-
-    except ErrorReturnCode as e:
-        print(f"Error running localscore: {e}")
-        return e.exit_code
     except Exception as e:
         print(f"Error: {e}")
         return 1
 
 
 def main():
+    # Print usage without building the argparse parser for a bare help request
+    if len(sys.argv) == 2 and sys.argv[1] in ("-h", "--help"):
+        print(__doc__.strip())
+        return 0
+
     import argparse
 
     parser = argparse.ArgumentParser(
@@ -218,7 +330,10 @@ def main():
     parser.add_argument("--download-model", action="store_true",
                         help="Download a model from HuggingFace")
     parser.add_argument("-f", "--force", action="store_true",
-                        help="Force download even if localscore is already in PATH")
+                        help="Link ./localscore to the cached LOCALSCORE_VERSION even if localscore is already in PATH, "
+                             "downloading it only if the cache is missing or stale")
+    parser.add_argument("--offline", action="store_true",
+                        help="Use a previously downloaded model without checking HuggingFace for updates")
 
     args = parser.parse_args()
 
@@ -232,7 +347,7 @@ def main():
         download_localscore(force=args.force)
 
     if args.download_model:
-        model_path = download_model_from_hf()
+        model_path = download_model_from_hf(offline=args.offline)
         if model_path is None:
             print("Failed to download model.")
             return 1